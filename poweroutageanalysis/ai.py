@@ -1,12 +1,26 @@
 """Contains classes/methods that will use the AI models to automatically parse the data."""
 
+import asyncio
+import json
 import logging
 import os
+from collections import Counter
+from typing import Any, Literal, TypeVar
 
 import dotenv
-from openai import AsyncOpenAI
-from pydantic import BaseModel
-
+import httpx
+from openai import (
+    AsyncOpenAI,
+    BadRequestError,
+    ContentFilterFinishReasonError,
+    DefaultAsyncHttpxClient,
+    LengthFinishReasonError,
+)
+from openai.types.chat import ChatCompletionMessageParam
+from pydantic import BaseModel, ValidationError
+
+from poweroutageanalysis.cache import ResponseCache
+from poweroutageanalysis.ratelimit import RateLimiter
 from poweroutageanalysis.types import PowerOutageEvent
 from poweroutageanalysis.util import check_for_na_value
 
@@ -14,6 +28,58 @@ dotenv.load_dotenv()
 
 AI_MODEL = "gpt-4o-mini-2024-07-18"
 
+# Greedy, seeded sampling so the same request gets the same response. Cached responses are only valid because of
+# this, so these settings are part of the response cache key and are sent with every live and Batch API request.
+COMPLETION_SETTINGS: dict[str, Any] = {"model": AI_MODEL, "temperature": 0, "seed": 42}
+
+# Cap on the response tokens, single responses are a short ISO datetime or a number wrapped in JSON
+MAX_COMPLETION_TOKENS = 64
+
+# Extra response tokens allowed per row when many rows are sent in a single request
+MAX_COMPLETION_TOKENS_PER_ROW = 32
+
+# The system prompts are kept identical across every request, with all the per-event data in the user message.
+# OpenAI's automatic prompt caching only starts at 1024 prompt tokens, and these prompts are deliberately kept well
+# below that (~100-250 tokens), since padding them up to it would cost more than the cache discount saves.
+SYSTEM_ADD_START = """Below are is a date string and a time string. Please return the ISO 8601 datetime that represents the values from both the date and time strings. The new datetime should not have a time zone specified. The input date string is in the format m/d/YY and the input time string is in the format HH:MM a.m. or HH:MM p.m. If the input time is not provided, assume it is 00:00:00."""  # noqa: E501
+
+SYSTEM_ADD_RESTORED = """Below is a string that represents the restoration date and time for a power outage event. The string is written in English and needs to be converted to a ISO 8601 datetime.
+
+Please return the ISO 8601 datetime that represents the restoration date and time, considering the following:
+- The restoration datetime should be less than 6 months after the start date of the event.
+- The input string is in the format 'HH:MM a.m./p.m. Month D', e.g., '6:00 a.m. June 2', but might be in a different format. We have to do our best to parse it.
+- Use the start date's year for the restoration datetime, unless the restoration date is earlier than the start date. In that case, assume the restoration occurred in the following year.
+- The output datetime should not have a time zone specified.
+- If the restoration time is not provided, and only the date is present, assume the time is 23:59:59."""  # noqa: E501
+
+SYSTEM_FIX_NUMBER = """Below is a string that is suppsed to represent an integer. Please return the correct numeric value as an integer.
+- If the string specifies a range, return the highest value in the range.
+- If the string lists an English word for the number or approximate number, return the numeric value closest to that representation.
+- If the string is empty or specifies that the value is not available, return -1."""  # noqa: E501
+
+# Appended to the datetime prompts when many events are sent in a single request
+MULTI_ROW_INSTRUCTIONS = """The input is a JSON list of rows, each with an id. Apply the instructions above to every row, and return an item with the same id and the resulting datetime for each row."""  # noqa: E501
+
+SYSTEM_ADD_START_BATCH = f"{SYSTEM_ADD_START}\n\n{MULTI_ROW_INSTRUCTIONS}"
+SYSTEM_ADD_RESTORED_BATCH = f"{SYSTEM_ADD_RESTORED}\n\n{MULTI_ROW_INSTRUCTIONS}"
+
+# Polling interval bounds (in seconds) while waiting for a Batch API job to finish
+BATCH_POLL_INITIAL_DELAY = 5
+BATCH_POLL_MAX_DELAY = 300
+
+# Maximum number of AI requests in flight at once
+MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "20"))
+
+# Account rate limits for the AI model, the bucket keeps us just under these
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+
+# Seconds to wait on a single AI request before giving up (and retrying)
+REQUEST_TIMEOUT = 60
+
+# The structured output model a completion is parsed into
+ResponseT = TypeVar("ResponseT", bound=BaseModel)
+
 
 class DateResponse(BaseModel):
     """The response from the AI model."""
@@ -27,6 +93,19 @@ class NumberResponse(BaseModel):
     number: int
 
 
+class DateItem(BaseModel):
+    """One row of a multi-row response from the AI model."""
+
+    id: int
+    datetime: str
+
+
+class DateBatchResponse(BaseModel):
+    """The response from the AI model for a request with many rows."""
+
+    items: list[DateItem]
+
+
 class PowerOutageAI:
     """Class with methods that implement fixes to the data using the AI models."""
 
@@ -34,102 +113,225 @@ class PowerOutageAI:
         """Initialize the PowerOutageAI class."""
         self.log = logging.getLogger(__name__)
         self.log.info("Initializing PowerOutageAI")
-        self.client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+        self.cache = ResponseCache()
+
+        self._sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        self._bucket = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+        # One client (and connection pool) is shared by every request for the lifetime of the process.
+        # The pool keeps a warm connection for every request that can be in flight at once,
+        # and the rate limit headers of every response are fed back into the bucket.
+        self.client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "5")),
+            timeout=REQUEST_TIMEOUT,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY),
+                event_hooks={"response": [self._bucket.update_from_response]},
+            ),
+        )
+
+    async def aclose(self) -> None:
+        """Close the AI client and its pooled connections, and the response cache."""
+        await self.client.close()
+
+        self.log.info(f"AI response cache: {self.cache.hits} hits, {self.cache.misses} misses")
+        self.cache.close()
+
+    async def parse_completion(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        response_format: type[ResponseT],
+        max_completion_tokens: int = MAX_COMPLETION_TOKENS,
+    ) -> ResponseT | None:
+        """Run a structured output chat completion, staying under the concurrency and rate limits.
+
+        Responses are cached, so the same request is only ever sent to the AI model once.
+        """
+        cache_key = self.cache.key(messages, COMPLETION_SETTINGS)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return response_format.model_validate_json(cached)
+
+        estimated_tokens = len(json.dumps(messages)) // 4 + max_completion_tokens
+
+        async with self._sem:
+            await self._bucket.acquire(estimated_tokens)
+            try:
+                response = await self.client.beta.chat.completions.parse(
+                    **COMPLETION_SETTINGS,
+                    messages=messages,
+                    response_format=response_format,
+                    max_completion_tokens=max_completion_tokens,
+                )
+            except LengthFinishReasonError:
+                # The response hit max_completion_tokens and was cut off, leave it to the caller's fallback
+                self.log.exception(f"Response was cut off at {max_completion_tokens} tokens")
+                return None
+
+        if response.usage is not None:
+            self.log.debug(
+                "Prompt tokens: %d, completion tokens: %d",
+                response.usage.prompt_tokens,
+                response.usage.completion_tokens,
+            )
+
+        parsed = response.choices[0].message.parsed
+        if parsed is not None:
+            self.cache.set(cache_key, parsed.model_dump_json())
+
+        return parsed
 
     async def add_start_datetime(self, event: PowerOutageEvent) -> PowerOutageEvent:
         """Add start_datetime to the PowerOutageEvent using the AI model."""
-        self.log.info(f"Adding start datetime to event: {event}")
+        self.log.debug("Adding start datetime to event: %s", event)
 
-        # Use the AI model to add the start datetime
-        system_prompt = """Below are is a date string and a time string. Please return the ISO 8601 datetime that represents the values from both the date and time strings. The new datetime should not have a time zone specified. The input date string is in the format m/d/YY and the input time string is in the format HH:MM a.m. or HH:MM p.m. If the input time is not provided, assume it is 00:00:00.
-        """  # noqa: E501
-
-        data_message = f"Date: {event.date}\nTime: {event.time}"
+        if event.start_datetime is not None:
+            self.log.debug("Start datetime already parsed")
+            return event
 
-        response = await self.client.beta.chat.completions.parse(
-            model=AI_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": data_message},
-            ],
-            response_format=DateResponse,
-        )
-        message = response.choices[0].message
+        # Use the AI model to add the start datetime
+        parsed = await self.parse_completion(self.start_datetime_messages(event), DateResponse)
 
-        if message.parsed:
-            event.start_datetime = message.parsed.datetime
-            self.log.info(f"Added start datetime to event: {event}")
+        if parsed:
+            event.start_datetime = parsed.datetime
+            self.log.debug("Added start datetime to event: %s", event)
         else:
             self.log.error(f"Failed to add start datetime to event: {event}")
 
         return event
 
+    def start_datetime_messages(self, event: PowerOutageEvent) -> list[ChatCompletionMessageParam]:
+        """Build the chat messages used to add start_datetime to an event."""
+        data_message = f"Date: {event.date}\nTime: {event.time}"
+
+        return [
+            {"role": "system", "content": SYSTEM_ADD_START},
+            {"role": "user", "content": data_message},
+        ]
+
     async def add_restored_datetime(self, event: PowerOutageEvent) -> PowerOutageEvent:
         """Add restored_datetime to the PowerOutageEvent using the AI model."""
-        self.log.info(f"Adding restored datetime to event: {event}")
+        self.log.debug("Adding restored datetime to event: %s", event)
+
+        if event.restored_datetime is not None:
+            self.log.debug("Restored datetime already parsed")
+            return event
 
         # Try a simple check to handle when there is no listed restoration time
         check = check_for_na_value(event.restoration_time)
         if check is None:
-            self.log.info("No restoration time provided")
+            self.log.debug("No restoration time provided")
             return event
 
         # Use the AI model to add the restored datetime
-        system_prompt = """
-        Below is a string that represents the restoration date and time for a power outage event. The string is written in English and needs to be converted to a ISO 8601 datetime.
+        parsed = await self.parse_completion(self.restored_datetime_messages(event), DateResponse)
 
-        Please return the ISO 8601 datetime that represents the restoration date and time, considering the following:
-        - The restoration datetime should be less than 6 months after the start date of the event.
-        - The input string is in the format 'HH:MM a.m./p.m. Month D', e.g., '6:00 a.m. June 2', but might be in a different format. We have to do our best to parse it.
-        - Use the start date's year for the restoration datetime, unless the restoration date is earlier than the start date. In that case, assume the restoration occurred in the following year.
-        - The output datetime should not have a time zone specified.
-        - If the restoration time is not provided, and only the date is present, assume the time is 23:59:59.
-        """  # noqa: E501
+        if parsed:
+            event.restored_datetime = parsed.datetime
+            self.log.debug("Added restored datetime to event: %s", event)
+        else:
+            self.log.error(f"Failed to add restored datetime to event: {event}")
+
+        return event
 
+    def restored_datetime_messages(self, event: PowerOutageEvent) -> list[ChatCompletionMessageParam]:
+        """Build the chat messages used to add restored_datetime to an event."""
         data_message = f"Start Date: {event.date}\nRestoration Time: {event.restoration_time}"
 
-        response = await self.client.beta.chat.completions.parse(
-            model=AI_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": data_message},
-            ],
-            response_format=DateResponse,
-        )
-        message = response.choices[0].message
+        return [
+            {"role": "system", "content": SYSTEM_ADD_RESTORED},
+            {"role": "user", "content": data_message},
+        ]
 
-        if message.parsed:
-            event.restored_datetime = message.parsed.datetime
-            self.log.info(f"Added restored datetime to event: {event}")
-        else:
-            self.log.error(f"Failed to add restored datetime to event: {event}")
+    async def add_start_datetimes_batch(self, events: list[PowerOutageEvent]) -> list[PowerOutageEvent]:
+        """Add start_datetime to many events with a single request to the AI model.
 
-        return event
+        Events missing from the response fall back to a request of their own.
+        """
+        pending = [event for event in events if event.start_datetime is None]
+        rows = [{"id": row_id, "date": event.date, "time": event.time} for row_id, event in enumerate(pending)]
+
+        datetimes = await self.parse_datetimes_batch(SYSTEM_ADD_START_BATCH, rows)
+        for row_id, event in enumerate(pending):
+            event.start_datetime = datetimes.get(row_id)
+
+        await asyncio.gather(*(self.add_start_datetime(event) for event in pending if event.start_datetime is None))
+
+        return events
+
+    async def add_restored_datetimes_batch(self, events: list[PowerOutageEvent]) -> list[PowerOutageEvent]:
+        """Add restored_datetime to many events with a single request to the AI model.
+
+        Events missing from the response fall back to a request of their own.
+        """
+        pending = [
+            event
+            for event in events
+            if event.restored_datetime is None and check_for_na_value(event.restoration_time) is not None
+        ]
+        rows = [
+            {"id": row_id, "start_date": event.date, "restoration_time": event.restoration_time}
+            for row_id, event in enumerate(pending)
+        ]
+
+        datetimes = await self.parse_datetimes_batch(SYSTEM_ADD_RESTORED_BATCH, rows)
+        for row_id, event in enumerate(pending):
+            event.restored_datetime = datetimes.get(row_id)
+
+        await asyncio.gather(
+            *(self.add_restored_datetime(event) for event in pending if event.restored_datetime is None),
+        )
+
+        return events
+
+    async def parse_datetimes_batch(self, system_prompt: str, rows: list[dict[str, Any]]) -> dict[int, str]:
+        """Parse the datetimes of many rows with a single request, returning the datetimes keyed by row id."""
+        if not rows:
+            return {}
+
+        self.log.debug("Parsing %d datetimes in a single request", len(rows))
+
+        # A response the model couldn't complete, or a request too large to send, leaves every row to the per-event
+        # fallback. Rate limit, connection and auth errors were already retried, and would only fail again per event.
+        try:
+            parsed = await self.parse_completion(
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": json.dumps(rows)},
+                ],
+                DateBatchResponse,
+                max_completion_tokens=MAX_COMPLETION_TOKENS + MAX_COMPLETION_TOKENS_PER_ROW * len(rows),
+            )
+        except (BadRequestError, ContentFilterFinishReasonError, ValidationError):
+            self.log.exception(f"Failed to parse {len(rows)} datetimes in a single request")
+            return {}
+        if parsed is None:
+            self.log.error(f"Failed to parse {len(rows)} datetimes in a single request")
+            return {}
+
+        # Only trust the ids we sent, and only when the model answered them once
+        id_counts = Counter(item.id for item in parsed.items)
+        datetimes = {
+            item.id: item.datetime for item in parsed.items if 0 <= item.id < len(rows) and id_counts[item.id] == 1
+        }
+        if len(datetimes) < len(parsed.items):
+            dropped = len(parsed.items) - len(datetimes)
+            self.log.warning(f"Dropped {dropped} unknown or duplicated ids from the multi-row response")
+
+        return datetimes
 
     async def fix_number(self, value: str) -> int | None:
         """Fix a number using the AI model."""
-        self.log.info(f"Fixing number: {value}")
+        self.log.debug("Fixing number: %s", value)
 
         # Use the AI model to fix the number
-        system_prompt = """Below is a string that is suppsed to represent an integer. Please return the correct numeric value as an integer.
-        - If the string specifies a range, return the highest value in the range.
-        - If the string lists an English word for the number or approximate number, return the numeric value closest to that representation.
-        - If the string is empty or specifies that the value is not available, return -1.
-        """  # noqa: E501
-
-        response = await self.client.beta.chat.completions.parse(
-            model=AI_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": value},
-            ],
-            response_format=NumberResponse,
-        )
-        message = response.choices[0].message
+        parsed = await self.parse_completion(self.fix_number_messages(value), NumberResponse)
 
-        if message.parsed:
-            fixed_number = int(message.parsed.number)
-            self.log.info(f"Fixed number: {fixed_number}")
+        if parsed:
+            fixed_number = int(parsed.number)
+            self.log.debug("Fixed number: %s", fixed_number)
         else:
             self.log.error(f"Failed to fix number: {value}")
             fixed_number = None
@@ -137,3 +339,144 @@ class PowerOutageAI:
         if fixed_number == -1:
             return None
         return fixed_number
+
+    def fix_number_messages(self, value: str) -> list[ChatCompletionMessageParam]:
+        """Build the chat messages used to fix a number."""
+        return [
+            {"role": "system", "content": SYSTEM_FIX_NUMBER},
+            {"role": "user", "content": value},
+        ]
+
+    async def submit_batch(
+        self,
+        events: list[PowerOutageEvent],
+        kind: Literal["start", "restored"],
+    ) -> dict[str, DateResponse]:
+        """Parse the start or restored datetime for many events at once using the OpenAI Batch API.
+
+        Args:
+            events (list[PowerOutageEvent]): The events to process. The index of each event is used as its custom_id.
+            kind (Literal["start", "restored"]): Which datetime to parse out of the events.
+
+        Returns:
+            dict[str, DateResponse]: The parsed (or cached) responses, keyed by custom_id.
+
+        """
+        self.log.info(f"Building {kind} datetime batch for {len(events)} events")
+
+        results: dict[str, DateResponse] = {}
+        cache_keys: dict[str, str] = {}
+        lines = []
+        for event_id, event in enumerate(events):
+            if kind == "start":
+                messages = self.start_datetime_messages(event)
+            else:
+                # Don't bother the AI model with events that have no listed restoration time
+                if check_for_na_value(event.restoration_time) is None:
+                    continue
+                messages = self.restored_datetime_messages(event)
+
+            # Only send the requests we don't already have a cached response for
+            cache_key = self.cache.key(messages, COMPLETION_SETTINGS)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                results[str(event_id)] = DateResponse.model_validate_json(cached)
+                continue
+            cache_keys[str(event_id)] = cache_key
+
+            request = {
+                "custom_id": str(event_id),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    **COMPLETION_SETTINGS,
+                    "messages": messages,
+                    "response_format": response_format_for(DateResponse),
+                    "max_completion_tokens": MAX_COMPLETION_TOKENS,
+                },
+            }
+            lines.append(json.dumps(request))
+
+        if not lines:
+            self.log.info(f"No events need a {kind} datetime from the AI model, skipping batch")
+            return results
+
+        # Upload the requests and start the batch job
+        batch_input = await self.client.files.create(
+            file=(f"{kind}_datetime_batch.jsonl", "\n".join(lines).encode()),
+            purpose="batch",
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        self.log.info(f"Submitted {kind} datetime batch {batch.id} with {len(lines)} requests")
+
+        # Poll the batch job with exponential backoff until it reaches a terminal state
+        delay = BATCH_POLL_INITIAL_DELAY
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            self.log.info(f"Batch {batch.id} is {batch.status}, checking again in {delay} seconds")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+            batch = await self.client.batches.retrieve(batch.id)
+
+        if batch.status != "completed" or batch.output_file_id is None:
+            self.log.error(f"Batch {batch.id} finished with status {batch.status}")
+            return results
+
+        if batch.error_file_id is not None:
+            self.log.warning(f"Batch {batch.id} has failed requests, see file {batch.error_file_id}")
+
+        # Download the results and map each custom_id to its parsed response
+        batch_output = await self.client.files.content(batch.output_file_id)
+
+        batch_results = self.parse_batch_output(batch_output.text)
+        for custom_id, parsed in batch_results.items():
+            self.cache.set(cache_keys[custom_id], parsed.model_dump_json())
+            results[custom_id] = parsed
+        self.log.info(f"Parsed {len(batch_results)} {kind} datetimes from batch {batch.id}")
+
+        return results
+
+    def parse_batch_output(self, text: str) -> dict[str, DateResponse]:
+        """Parse the JSONL output file of a Batch API job into DateResponses keyed by custom_id."""
+        results: dict[str, DateResponse] = {}
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:  # noqa: PLR2004
+                self.log.error(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+                continue
+
+            choice = response["body"]["choices"][0]
+            if choice.get("finish_reason") == "length":
+                self.log.error(f"Batch request {result['custom_id']} was cut off at {MAX_COMPLETION_TOKENS} tokens")
+                continue
+
+            content = choice["message"].get("content")
+            if not content:
+                self.log.error(f"Batch request {result['custom_id']} returned no content")
+                continue
+
+            try:
+                results[result["custom_id"]] = DateResponse.model_validate_json(content)
+            except ValidationError:
+                self.log.exception(f"Batch request {result['custom_id']} returned an invalid response: {content}")
+
+        return results
+
+
+def response_format_for(model: type[BaseModel]) -> dict[str, Any]:
+    """Build the structured output response_format for a raw (non-parse) chat completion request."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": {**model.model_json_schema(), "additionalProperties": False},
+            "strict": True,
+        },
+    }
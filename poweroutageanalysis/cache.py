@@ -0,0 +1,53 @@
+"""Contains a persistent cache for the responses of the AI models."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessageParam
+
+# Where the AI responses are cached between runs
+AI_CACHE_PATH = "data/.aicache.sqlite3"
+
+
+class ResponseCache:
+    """Exact-match disk cache of AI responses, keyed by a hash of the prompt and completion settings."""
+
+    def __init__(self, path: str = AI_CACHE_PATH) -> None:
+        """Open (or create) the cache database."""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        # Autocommit so every response is persisted as soon as we get it
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(messages: list[ChatCompletionMessageParam], settings: dict[str, Any]) -> str:
+        """Build the cache key for a request from its messages and completion settings (model, sampling, etc.)."""
+        return hashlib.sha256(json.dumps([messages, settings], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """Get a cached response, or None if we haven't seen this request before."""
+        row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, response: str) -> None:
+        """Cache a response."""
+        self.db.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (key, response))
+
+    def close(self) -> None:
+        """Close the cache database."""
+        self.db.close()
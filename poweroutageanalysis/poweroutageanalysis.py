@@ -4,12 +4,14 @@ from __future__ import annotations
 
 import asyncio
 import csv
+import itertools
 import logging
+import operator
 import os
-import re
 import time
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import pandas as pd
 from dotenv import load_dotenv
@@ -18,7 +20,18 @@ from rich.table import Table
 
 from poweroutageanalysis.ai import PowerOutageAI
 from poweroutageanalysis.types import PowerOutageEvent
-from poweroutageanalysis.util import clean_num_string
+from poweroutageanalysis.util import (
+    check_for_na_value,
+    clean_num_series,
+    format_xls_time,
+    parse_number_words,
+    split_region_series,
+    try_parse_datetime,
+    try_parse_restored_datetime,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Iterator
 
 load_dotenv()
 
@@ -32,6 +45,19 @@ NORMALIZED_SUFFIX = "_Normalized"
 # Set the range of years to process
 YEAR_RANGE = range(2002, 2003)
 
+# Number of CSV rows to read and clean at once
+CSV_CHUNK_SIZE = 10_000
+
+# The free text fields of PowerOutageEvent, and the ones every event must have
+TEXT_FIELDS = ["date", "time", "region", "area_affected", "outage_type", "utility_name", "restoration_time"]
+REQUIRED_FIELDS = ["date", "outage_type"]
+
+# Submit the datetime parsing through the OpenAI Batch API (half the cost, but results can take a while)
+USE_BATCH_API = os.getenv("OPENAI_USE_BATCH_API", "true").lower() == "true"
+
+# Without the Batch API, this many events are sent to the AI model in each request
+MULTI_ROW_BATCH_SIZE = int(os.getenv("OPENAI_MULTI_ROW_BATCH_SIZE", "20"))
+
 # 2000 and 2001 have been parsed out of the PDFs into the CSV files (using ChatGPT).
 # This is due to the fact that only the PDF was available for those years.
 # All remaining years are in the Excel files.
@@ -55,6 +81,9 @@ class PowerOutageAnalysis:
     data: list[PowerOutageEvent]
     ai: PowerOutageAI
 
+    # Numbers that could not be cleaned while loading, as (event, field name, raw value)
+    pending_number_fixes: list[tuple[PowerOutageEvent, str, str]]
+
     def __init__(self) -> None:
         """Initialize PowerOutageAnalysis class."""
         logging.basicConfig(level=logging.INFO)
@@ -89,6 +118,7 @@ class PowerOutageAnalysis:
         self.ai = PowerOutageAI()
 
         self.data = []
+        self.pending_number_fixes = []
         self.analyze_power_outages()
 
     def analyze_power_outages(self) -> None:
@@ -97,11 +127,18 @@ class PowerOutageAnalysis:
 
         self.load_data()
 
-        asyncio.run(self.augment_data_with_ai())
+        asyncio.run(self.process_data())
 
-        self.log.warning("DONE ANALYZING POWER OUTAGES")
-        self.log.warning("OUTPUTTING RESULTS")
-        asyncio.run(self.output_results())
+    async def process_data(self) -> None:
+        """Augment and output the loaded data, all on a single event loop so AI connections are reused."""
+        try:
+            # The results are written out as the events come out of the AI augmentation
+            self.log.warning("OUTPUTTING RESULTS AS THEY ARE ANALYZED")
+            await self.output_results(self.augment_data_with_ai())
+
+            self.log.warning("DONE ANALYZING POWER OUTAGES")
+        finally:
+            await self.ai.aclose()
 
     def load_data(self) -> None:
         """Load data from the database."""
@@ -125,80 +162,37 @@ class PowerOutageAnalysis:
         for year in YEAR_RANGE:
             self.log.info(f"Processing data for {year}")
             if f"{year}{FILE_SUFFIX}.xls" in xls_files:
-                self.process_xls_file(year)
+                events = self.process_xls_file(year)
             elif f"{year}{FILE_SUFFIX_CSV}.csv" in csv_files:
-                self.process_csv_file(year)
+                events = self.process_csv_file(year)
             else:
                 msg = f"No data file found for {year}"
                 raise FileNotFoundError(msg)
 
-    def process_csv_file(self, year: int) -> None:
-        """Process a CSV file."""
+            # The events are parsed lazily, one row at a time, as we consume them
+            event_count = len(self.data)
+            self.data.extend(events)
+            self.log.info("Processed %d events for %d", len(self.data) - event_count, year)
+
+    def process_csv_file(self, year: int) -> Iterator[PowerOutageEvent]:
+        """Process a CSV file, streaming the events as the rows are read."""
         self.log.info(f"Processing CSV file for {year}")
 
         # Combine the path and filename
         file_path = Path(ORIGINAL_DATA_PATH) / f"{year}{FILE_SUFFIX_CSV}.csv"
 
-        # Read the csv into memory
-        rows = []
         self.log.info(f"Reading data from {file_path}")
 
-        # Read in the CSV file
-        with file_path.open("r") as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=",", quotechar='"')
-            rows = list(reader)
-        self.log.info(f"Found {len(rows)} rows in the CSV file")
-
-        # Process the data
-        for row in rows:
-            self.log.info(row)
-            customers_affected: int | None
-            try:
-                customers_affected = clean_num_string(row["Number of Customers Affected"])
-            except ValueError:
-                self.log.warning("customers_affected ValueError, trying to fix with AI")
-                customers_affected = asyncio.run(self.ai.fix_number(row["Number of Customers Affected"]))
-
-            demand_loss_mw: int | None
-            try:
-                demand_loss_mw = clean_num_string(row["Loss (megawatts)"])
-            except ValueError:
-                self.log.warning("demand_loss_mw ValueError, trying to fix with AI")
-                demand_loss_mw = asyncio.run(self.ai.fix_number(row["Loss (megawatts)"]))
-
-            # Try to parse out the region from the utility name.
-            # Sometimes the region is in parentheses at the end of the utility name.
-            # Region names are always 2 to 6 letters long in uppercase.
-
-            region = None
-            utility_name = row["Utility/Power Pool (NERC Council)"].strip()
-            if utility_name and utility_name[-1] == ")":
-                # Try to find the region in parentheses at the end of the utility name
-                match = re.search(r"\(([A-Z]{2,6})\)$", utility_name)
-                if match:
-                    region = match.group(1)
-                    utility_name = utility_name[: match.start()].strip()
-
-            try:
-                event = PowerOutageEvent(
-                    date=row["Date"],
-                    time=row["Time"],
-                    region=region,
-                    area_affected=row["Area"],
-                    customers_affected=customers_affected,
-                    demand_loss_mw=demand_loss_mw,
-                    outage_type=row["Type of Disturbance"],
-                    utility_name=utility_name,
-                    restoration_time=row["Restoration Time"],
-                )
-                self.data.append(event)
-                self.log.info(f"SUCCESSFULLY PROCESSED ROW:\n{event}")
-            except KeyError:
-                self.log.exception("Error processing row, column mismatch")
-            except ValueError:
-                self.log.exception("Error processing row, value error")
-
-    def process_xls_file(self, year: int) -> None:
+        # Read in the CSV file in chunks, keeping every value as the raw string
+        row_count = 0
+        with pd.read_csv(file_path, dtype=str, keep_default_na=False, chunksize=CSV_CHUNK_SIZE) as reader:
+            for chunk in reader:
+                row_count += len(chunk)
+                yield from self.process_frame(chunk)
+
+        self.log.info(f"Found {row_count} rows in the CSV file")
+
+    def process_xls_file(self, year: int) -> Iterator[PowerOutageEvent]:
         """Process an XLS file.
 
         Args:
@@ -211,11 +205,11 @@ class PowerOutageAnalysis:
         file_path = Path(ORIGINAL_DATA_PATH) / f"{year}{FILE_SUFFIX}.xls"
 
         # Read the XLS file into memory
-        rows = []
         self.log.info(f"Reading data from {file_path}")
 
-        xls_df = pd.read_excel(file_path)
-        xls_df = pd.read_excel(file_path, header=None)
+        # Read the sheet once with the calamine (Rust) reader, without a header (we find it below) and without pandas
+        # inferring the column types
+        xls_df = pd.read_excel(file_path, header=None, engine="calamine", dtype=object)
 
         # Find the row index of the header row
         header_row_index = xls_df.iloc[:, 2].first_valid_index()
@@ -224,124 +218,209 @@ class PowerOutageAnalysis:
         xls_df.columns = xls_df.iloc[header_row_index]
         xls_df = xls_df[header_row_index + 1 :]
 
-        rows = xls_df.to_dict(orient="records")
-
-        self.log.info(f"Found {len(rows)} rows in the XLS file")
+        self.log.info(f"Found {len(xls_df)} rows in the XLS file")
 
-        # Process the data
-        for row in rows:
-            self.log.info(row)
+        if "Date" in xls_df:
+            # Skip rows that don't have a valid date (e.g. the month headings and blank rows)
+            valid_dates = xls_df["Date"].map(lambda value: isinstance(value, datetime)).astype(bool)
+            self.log.warning(f"Skipping {(~valid_dates).sum()} rows without valid date")
+            xls_df = xls_df[valid_dates]
 
-            if "Date" in row and not isinstance(row["Date"], datetime):
-                # Skip rows that don't have a valid date
-                self.log.warning("Skipping row without valid date")
-                continue
+            xls_df = xls_df.assign(Date=pd.to_datetime(xls_df["Date"]).dt.strftime("%Y-%m-%d"))
 
-            customers_affected: int | None
-            try:
-                customers_affected = clean_num_string(str(row["Number of Customers Affected"]))
-            except ValueError:
-                self.log.warning("customers_affected ValueError, trying to fix with AI")
-                customers_affected = asyncio.run(self.ai.fix_number(str(row["Number of Customers Affected"])))
+        # The times and restoration times are usually time/datetime cells, but can be free text
+        if "Time" in xls_df:
+            xls_df = xls_df.assign(Time=xls_df["Time"].map(format_xls_time))
+        if "Restoration Time" in xls_df:
+            xls_df = xls_df.assign(**{"Restoration Time": xls_df["Restoration Time"].map(format_xls_time)})
 
-            demand_loss_mw: int | None
-            try:
-                demand_loss_mw = clean_num_string(str(row["Loss (megawatts)"]))
-            except ValueError:
-                self.log.warning("demand_loss_mw ValueError, trying to fix with AI")
-                demand_loss_mw = asyncio.run(self.ai.fix_number(str(row["Loss (megawatts)"])))
+        yield from self.process_frame(xls_df)
 
-            # Try to parse out the region from the utility name.
-            # Sometimes the region is in parentheses at the end of the utility name.
-            # Region names are always 2 to 6 letters long in uppercase.
+    def process_frame(self, frame: pd.DataFrame) -> Iterator[PowerOutageEvent]:
+        """Clean a DataFrame of raw rows using vectorized operations, then convert the rows into events."""
+        try:
+            customers_affected, customers_failed = clean_num_series(frame["Number of Customers Affected"])
+            demand_loss_mw, demand_loss_failed = clean_num_series(frame["Loss (megawatts)"])
 
-            region = None
-
-            if "NERC Region" in row:
-                region = row["NERC Region"]
-                utility_name = None
+            if "NERC Region" in frame:
+                region = frame["NERC Region"]
+                utility_name = pd.Series(None, index=frame.index, dtype=object)
             else:
-                utility_name = row["Utility/Power Pool (NERC Council)"].strip()
-                if utility_name and utility_name[-1] == ")":
-                    # Try to find the region in parentheses at the end of the utility name
-                    match = re.search(r"\(([A-Z]{2,6})\)$", utility_name)
-                    if match:
-                        region = match.group(1)
-                        utility_name = utility_name[: match.start()].strip()
-
-            try:
-                event = PowerOutageEvent(
-                    date=row["Date"].strftime("%Y-%m-%d"),
-                    # date=row["Date"],
-                    time=row["Time"].strftime("%H:%M:%S"),
-                    region=region,
-                    area_affected=row["Area"],
-                    customers_affected=customers_affected,
-                    demand_loss_mw=demand_loss_mw,
-                    outage_type=row["Type of Disturbance"],
-                    utility_name=utility_name,
-                    restoration_time=row["Restoration Time"],
+                # Try to parse out the region from the utility name.
+                # Sometimes the region is in parentheses at the end of the utility name.
+                region, utility_name = split_region_series(frame["Utility/Power Pool (NERC Council)"])
+
+            cleaned = pd.DataFrame(
+                {
+                    "date": frame["Date"],
+                    "time": frame["Time"],
+                    "region": region,
+                    "area_affected": frame["Area"],
+                    "customers_affected": customers_affected,
+                    "demand_loss_mw": demand_loss_mw,
+                    "outage_type": frame["Type of Disturbance"],
+                    "utility_name": utility_name,
+                    "restoration_time": frame["Restoration Time"],
+                },
+            )
+        except KeyError:
+            self.log.exception("Error processing rows, column mismatch")
+            return
+
+        # Validate and coerce the whole frame up front, so the events can be built without per-row validation.
+        # The text fields are always strings (spreadsheet cells can hold numbers), and missing values become None.
+        cleaned[TEXT_FIELDS] = cleaned[TEXT_FIELDS].astype(str).where(cleaned[TEXT_FIELDS].notna())
+
+        missing_required = cleaned[REQUIRED_FIELDS].isna().any(axis=1)
+        if missing_required.any():
+            self.log.warning(f"Skipping {missing_required.sum()} rows missing one of {REQUIRED_FIELDS}")
+            cleaned = cleaned[~missing_required]
+
+        cleaned = cleaned.astype(object).where(cleaned.notna(), None)
+
+        # Logging every row is costly, so only do it when debugging
+        log_rows = self.log.isEnabledFor(logging.DEBUG)
+
+        for index, record in zip(cleaned.index, cleaned.to_dict(orient="records"), strict=True):
+            if log_rows:
+                self.log.debug("row=%s", record)
+
+            # Only the numbers the vectorized cleaning couldn't handle are looked at one by one
+            number_fixes: list[tuple[str, str]] = []
+            if customers_failed[index]:
+                record["customers_affected"] = self.clean_number(
+                    str(frame.loc[index, "Number of Customers Affected"]),
+                    "customers_affected",
+                    number_fixes,
                 )
-                self.data.append(event)
-                self.log.info(f"SUCCESSFULLY PROCESSED ROW:\n{event}")
-            except KeyError:
-                self.log.exception("Error processing row, column mismatch")
-            except ValueError:
-                self.log.exception("Error processing row, value error")
-
-    async def augment_data_with_ai(self) -> None:
-        """Augment the data with AI."""
+            if demand_loss_failed[index]:
+                record["demand_loss_mw"] = self.clean_number(
+                    str(frame.loc[index, "Loss (megawatts)"]),
+                    "demand_loss_mw",
+                    number_fixes,
+                )
+
+            event = PowerOutageEvent.model_construct(**record)
+            self.pending_number_fixes.extend((event, field, value) for field, value in number_fixes)
+            if log_rows:
+                self.log.debug("Processed row into event: %s", event)
+            yield event
+
+    def clean_number(self, value: str, field: str, number_fixes: list[tuple[str, str]]) -> int | None:
+        """Clean a number string the vectorized cleaning couldn't, queueing it to be fixed with AI if all else fails."""
+        # Try the numbers written in words before falling back to the AI model
+        try:
+            return parse_number_words(value)
+        except ValueError:
+            self.log.warning(f"{field} ValueError, will try to fix with AI")
+            number_fixes.append((field, value))
+            return None
+
+    async def augment_data_with_ai(self) -> AsyncIterator[PowerOutageEvent]:
+        """Augment the data with AI, yielding the events as soon as they are done."""
         self.log.info("Augmenting data with AI")
 
-        background_tasks = set()
+        await self.fix_numbers_with_ai()
 
-        async with asyncio.TaskGroup() as tg:
+        # Parse the datetimes in the formats we know first, so only the rest need the AI model
+        self.parse_datetimes()
+
+        # The durations are plain datetime arithmetic, so they are calculated as each event is yielded
+        if USE_BATCH_API:
+            # The batches cover every event, so nothing is done until they have all finished
+            await self.augment_data_with_batch_api()
             for event in self.data:
-                # Add the start datetime using the AI model
-                task = tg.create_task(self.ai.add_start_datetime(event))
-                background_tasks.add(task)
+                yield self.calculate_duration_minutes(event)
+            return
+
+        # Each chunk of events goes through all its steps in one task, the AI client caps the requests in flight.
+        # The chunks are yielded in order as they finish, while the later chunks are still running.
+        chunks = itertools.batched(self.data, MULTI_ROW_BATCH_SIZE)
+        tasks = [asyncio.create_task(self.augment_events(list(chunk))) for chunk in chunks]
+        try:
+            for task in tasks:
+                for event in await task:
+                    yield self.calculate_duration_minutes(event)
+        finally:
+            # Don't leave chunks running if we stopped early
+            for task in tasks:
+                task.cancel()
+
+    async def augment_events(self, events: list[PowerOutageEvent]) -> list[PowerOutageEvent]:
+        """Add the start and restored datetimes to a chunk of events using the AI model."""
+        await self.ai.add_start_datetimes_batch(events)
+        await self.ai.add_restored_datetimes_batch(events)
+        return events
+
+    def parse_datetimes(self) -> None:
+        """Parse the start and restored datetimes of the events that are in a known format, without the AI model."""
+        for event in self.data:
+            start_datetime = try_parse_datetime(event.date, event.time)
+            if start_datetime is not None:
+                event.start_datetime = start_datetime.isoformat()
+
+            restoration_time = check_for_na_value(event.restoration_time)
+            if restoration_time is not None:
+                restored_datetime = try_parse_restored_datetime(event.date, restoration_time)
+                if restored_datetime is not None:
+                    event.restored_datetime = restored_datetime.isoformat()
+
+        self.log.info(
+            f"Parsed {sum(event.start_datetime is not None for event in self.data)} start and "
+            f"{sum(event.restored_datetime is not None for event in self.data)} restored datetimes "
+            f"of {len(self.data)} events without AI",
+        )
 
-        # Wait for all the background tasks to complete
-        await asyncio.gather(*background_tasks)
+    async def fix_numbers_with_ai(self) -> None:
+        """Fix all the numbers that could not be cleaned while loading, in a single concurrent pass."""
+        # The same messy values show up again and again, so each distinct value is only fixed once
+        values = list(dict.fromkeys(value for _, _, value in self.pending_number_fixes))
+        self.log.info(f"Fixing {len(self.pending_number_fixes)} numbers ({len(values)} distinct values) with AI")
 
-        background_tasks = set()
+        fixed_numbers = dict(
+            zip(values, await asyncio.gather(*(self.ai.fix_number(value) for value in values)), strict=True),
+        )
 
-        async with asyncio.TaskGroup() as tg:
-            for event in self.data:
-                # Add the restored datetime using the AI model
-                task = tg.create_task(self.ai.add_restored_datetime(event))
-                background_tasks.add(task)
+        for event, field, value in self.pending_number_fixes:
+            setattr(event, field, fixed_numbers[value])
 
-        # Wait for all the background tasks to complete
-        await asyncio.gather(*background_tasks)
+        self.pending_number_fixes = []
 
-        # Get the results from the background tasks and update the data
-        results = [task.result() for task in background_tasks]
+    async def augment_data_with_batch_api(self) -> None:
+        """Augment the data with AI, using the Batch API for the start and restored datetimes."""
+        self.log.info("Augmenting data with the Batch API")
 
-        self.data = []
-        for event in results:
-            self.data.append(await self.get_duration_minutes(event))
+        # Only the events that couldn't be parsed without AI are sent in the batches
+        start_events = [event for event in self.data if event.start_datetime is None]
+        restored_events = [event for event in self.data if event.restored_datetime is None]
 
-    async def get_duration_minutes(self, event: PowerOutageEvent) -> PowerOutageEvent:
-        """Calculate the duration of the outage in minutes."""
-        self.log.info(f"Calculating duration in minutes for event: {event}")
+        # The restored prompt only needs the start date, so both batches run at the same time
+        start_results, restored_results = await asyncio.gather(
+            self.ai.submit_batch(start_events, "start"),
+            self.ai.submit_batch(restored_events, "restored"),
+        )
+
+        for custom_id, parsed in start_results.items():
+            start_events[int(custom_id)].start_datetime = parsed.datetime
+        for custom_id, parsed in restored_results.items():
+            restored_events[int(custom_id)].restored_datetime = parsed.datetime
 
+    def calculate_duration_minutes(self, event: PowerOutageEvent) -> PowerOutageEvent:
+        """Calculate the duration of the outage in minutes."""
         if event.start_datetime is None or event.restored_datetime is None:
-            self.log.info("Cannot calculate duration without start and restored datetimes")
+            self.log.debug("Cannot calculate duration without start and restored datetimes for event: %s", event)
             return event
 
         # Calculate the duration in minutes
-        start: datetime = datetime.fromisoformat(event.start_datetime)
-        end: datetime = datetime.fromisoformat(event.restored_datetime)
-        duration = end - start
+        duration = datetime.fromisoformat(event.restored_datetime) - datetime.fromisoformat(event.start_datetime)
         event.duration_minutes = int(duration.total_seconds() / 60)
 
-        self.log.info(f"Calculated duration in minutes: {event.duration_minutes}")
+        self.log.debug("Calculated duration of %d minutes for event: %s", event.duration_minutes, event)
 
         return event
 
-    async def output_results(self) -> None:
-        """Output the results."""
+    async def output_results(self, events: AsyncIterator[PowerOutageEvent]) -> None:
+        """Output the results, writing each event to the CSV as it arrives."""
         self.log.info("Outputting results as a CSV")
 
         # Output the results as a csv into the data/normalized directory
@@ -350,19 +429,9 @@ class PowerOutageAnalysis:
             / f"{YEAR_RANGE.start}{NORMALIZED_SUFFIX}-{YEAR_RANGE.stop}{NORMALIZED_SUFFIX}.csv"
         )
 
-        with output_path.open("w") as csvfile:
-            writer = csv.DictWriter(
-                csvfile,
-                fieldnames=PowerOutageEvent.model_fields.keys(),
-                quotechar='"',
-                quoting=csv.QUOTE_STRINGS,
-            )
-            writer.writeheader()
-
-            for event in self.data:
-                writer.writerow(event.model_dump())
-
-        self.log.info("Outputting results as a human readable table")
+        # Write plain tuples of the event fields with the C writer, rather than building a dict per event
+        fieldnames = list(PowerOutageEvent.model_fields.keys())
+        event_values = operator.attrgetter(*fieldnames)
 
         # Output the results as a human readable table
         table = Table(title="Power Outages")
@@ -376,19 +445,35 @@ class PowerOutageAnalysis:
         table.add_column("Demand Loss (MW)")
         table.add_column("Customers Affected")
 
-        for event in self.data:
-            # Log the results in a human readable ASCII table
-            table.add_row(
-                str(event.start_datetime),
-                str(event.restored_datetime),
-                str(event.duration_minutes),
-                event.outage_type,
-                event.region,
-                event.area_affected,
-                event.utility_name,
-                str(event.demand_loss_mw),
-                str(event.customers_affected),
-            )
+        # Write to a temporary file next to the output, and only replace the previous results once every event is
+        # written, so a failed or interrupted run leaves them untouched
+        temp_path = output_path.with_suffix(".csv.tmp")
+        try:
+            with temp_path.open("w") as csvfile:
+                writer = csv.writer(csvfile, quotechar='"', quoting=csv.QUOTE_STRINGS)
+                writer.writerow(fieldnames)
+
+                async for event in events:
+                    writer.writerow(event_values(event))
+
+                    # Log the results in a human readable ASCII table
+                    table.add_row(
+                        str(event.start_datetime),
+                        str(event.restored_datetime),
+                        str(event.duration_minutes),
+                        event.outage_type,
+                        event.region,
+                        event.area_affected,
+                        event.utility_name,
+                        str(event.demand_loss_mw),
+                        str(event.customers_affected),
+                    )
+
+            temp_path.replace(output_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+        self.log.info("Outputting results as a human readable table")
 
         console = Console(color_system="standard")
         console.print(table)
@@ -0,0 +1,70 @@
+"""Contains a token bucket rate limiter to keep the AI requests under the OpenAI rate limits."""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
+
+
+class RateLimiter:
+    """Token bucket that keeps requests just under the requests per minute and tokens per minute limits."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int) -> None:
+        """Initialize the RateLimiter class with a full bucket."""
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self.requests_remaining = float(requests_per_minute)
+        self.tokens_remaining = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+
+        # Waiters are served one at a time so a large request can't be starved by smaller ones
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> None:
+        """Refill the bucket based on the time elapsed since the last refill."""
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+
+        self.requests_remaining = min(
+            self.requests_per_minute,
+            self.requests_remaining + self.requests_per_minute * elapsed_minutes,
+        )
+        self.tokens_remaining = min(
+            self.tokens_per_minute,
+            self.tokens_remaining + self.tokens_per_minute * elapsed_minutes,
+        )
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until there is capacity for one request using the given number of tokens."""
+        tokens = min(tokens, self.tokens_per_minute)
+
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.requests_remaining >= 1 and self.tokens_remaining >= tokens:
+                    self.requests_remaining -= 1
+                    self.tokens_remaining -= tokens
+                    return
+
+                # Sleep just long enough for the bucket to refill what we are missing
+                wait_seconds = max(
+                    (1 - self.requests_remaining) * 60 / self.requests_per_minute,
+                    (tokens - self.tokens_remaining) * 60 / self.tokens_per_minute,
+                )
+                await asyncio.sleep(wait_seconds)
+
+    async def update_from_response(self, response: httpx.Response) -> None:
+        """Sync the bucket with the remaining requests/tokens reported by the OpenAI response headers."""
+        remaining_requests = response.headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            self.requests_remaining = min(self.requests_remaining, float(remaining_requests))
+
+        remaining_tokens = response.headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            self.tokens_remaining = min(self.tokens_remaining, float(remaining_tokens))
@@ -1,5 +1,58 @@
 """Contains utility functions for the poweroutageanalysis package."""
 
+import re
+from datetime import date, datetime, time
+
+import pandas as pd
+
+# English words for numbers, and the words/suffixes that multiply them
+NUMBER_WORDS = dict(
+    zip(
+        "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen "
+        "seventeen eighteen nineteen twenty thirty forty fifty sixty seventy eighty ninety".split(),
+        [*range(20), *range(20, 100, 10)],
+        strict=True,
+    ),
+)
+# A bare "m" isn't a multiplier, in the megawatt column it is the unit, e.g. "300 m"
+NUMBER_MULTIPLIERS = {"k": 1_000, "thousand": 1_000, "million": 1_000_000}
+
+NUMBER_WITH_MULTIPLIER_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(k|thousand|million)")
+NUMBER_WORD_SEPARATOR_RE = re.compile(r"[\s-]+")
+
+# A note in parentheses at the end of a value, e.g. "36073 (residential)"
+TRAILING_NOTE_RE = re.compile(r"\s*\(.*\)$")
+
+# Formats the dates and times have been seen in, in the order we try them
+DATE_FORMATS = ["%m/%d/%y", "%m/%d/%Y", "%Y-%m-%d"]
+TIME_FORMATS = ["%I:%M %p", "%I %p", "%H:%M:%S", "%H:%M"]
+
+# Values that mean a number or time is not available
+NA_VALUES = ["na", "n/a", "none", ""]
+
+# A restoration time like "6:00 a.m. June 2", "Noon Nov. 10" or just "June 2"
+RESTORATION_TIME_RE = re.compile(
+    r"(?:(\d{1,2}(?::\d{2})?\s*(?:a\.m\.|p\.m\.|am|pm)|noon|midnight)\s+)?([A-Za-z]+)\.?\s+(\d{1,2})",
+    flags=re.IGNORECASE,
+)
+
+# A utility name with a NERC region in parentheses at the end, e.g. "Duke Power Co. (SERC)".
+# Region names are always 2 to 6 letters long in uppercase.
+REGION_RE = re.compile(r"^(.*?)\s*\(([A-Z]{2,6})\)$")
+
+# Full month names and their abbreviations, e.g. "june", "jun" and "sept"
+MONTHS = {
+    name: number
+    for number, month in enumerate(
+        "january february march april may june july august september october november december".split(),
+        1,
+    )
+    for name in (month, month[:3])
+} | {"sept": 9}
+
+# The restoration should be less than this many months after the start, anything later is left to the AI model
+MAX_RESTORATION_MONTHS = 6
+
 
 def clean_num_string(value_str: str) -> int | None:
     """Remove leading and trailing whitespace from a string."""
@@ -13,9 +66,62 @@ def clean_num_string(value_str: str) -> int | None:
     return int(value_str)
 
 
-def check_for_na_value(value: str) -> str | None:
-    """Check if a value is 'NA', 'N/A', 'None', or an empty string."""
-    if value.lower() in ["na", "n/a", "none", ""]:
+def clean_num_series(values: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """Clean a whole column of number strings at once, the vectorized version of clean_num_string.
+
+    Returns the cleaned numbers (<NA> where not available or not cleanable), and a mask of the values that could not
+    be cleaned.
+    """
+    missing = values.isna()
+    cleaned = (
+        values.astype(str)
+        .str.replace(",", "", regex=False)
+        .str.replace("Approx.", "", regex=False)
+        .str.split("-")
+        .str[-1]
+        .str.strip()
+    )
+    missing |= cleaned.str.lower().isin(NA_VALUES)
+
+    numbers = pd.to_numeric(cleaned.mask(missing), errors="coerce")
+
+    # Only whole numbers are clean, anything else has to be fixed
+    failed = ~missing & (numbers.isna() | (numbers % 1 != 0))
+
+    return numbers.mask(failed).astype("Int64"), failed
+
+
+def split_region_series(names: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """Split the NERC region off the end of a whole column of utility names.
+
+    Returns the regions (NaN where there is none), and the utility names without the region.
+    """
+    utility_names = names.str.strip()
+    region = pd.Series(None, index=names.index, dtype=object)
+
+    # Only names ending in a parenthesis can have a region, so the regex skips every other name
+    candidates = utility_names.str.endswith(")", na=False)
+    if candidates.any():
+        parts = utility_names[candidates].str.extract(REGION_RE)
+        matched = parts[1].notna()
+        region[parts.index[matched]] = parts.loc[matched, 1]
+        utility_names[parts.index[matched]] = parts.loc[matched, 0]
+
+    return region, utility_names
+
+
+def format_xls_time(value: object) -> object:
+    """Format a time or datetime spreadsheet cell as a string, leaving free text (and missing values) untouched."""
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, time):
+        return value.strftime("%H:%M:%S")
+    return value
+
+
+def check_for_na_value(value: str | None) -> str | None:
+    """Check if a value is missing, 'NA', 'N/A', 'None', or an empty string."""
+    if value is None or value.lower() in NA_VALUES:
         return None
     return value
 
@@ -33,3 +139,159 @@ def remove_approx(value: str) -> str:
 def extract_highest_from_range(value: str) -> str:
     """Split a string on a dash and return the latter value."""
     return value.split("-")[-1]
+
+
+def parse_number_words(value: str) -> int:
+    """Parse a number written with words or a multiplier, e.g. "Approx. 2 million", "25k" or "two thousand".
+
+    Raises ValueError if the string can't be parsed.
+    """
+    value = remove_approx(remove_commas(value)).strip().lower()
+
+    # Drop a trailing note in parentheses
+    value = TRAILING_NOTE_RE.sub("", value)
+
+    if value.isdigit():
+        return int(value)
+
+    match = NUMBER_WITH_MULTIPLIER_RE.fullmatch(value)
+    if match:
+        return int(float(match.group(1)) * NUMBER_MULTIPLIERS[match.group(2)])
+
+    return words_to_number(value)
+
+
+def words_to_number(value: str) -> int:
+    """Convert an English number, e.g. "two hundred fifty thousand", to an integer.
+
+    Raises ValueError if the string contains anything other than number words.
+    """
+    words = [word for word in NUMBER_WORD_SEPARATOR_RE.split(value.strip().lower()) if word != "and"]
+    if not words or words == [""]:
+        msg = f"No number words in {value!r}"
+        raise ValueError(msg)
+
+    total = 0
+    current = 0
+    for word in words:
+        if word in NUMBER_WORDS:
+            current += NUMBER_WORDS[word]
+        elif word == "hundred" or word in NUMBER_MULTIPLIERS:
+            # A bare "K" or "thousand" doesn't say how many, so it is left to the AI model
+            if current == 0:
+                msg = f"No number before {word!r} in {value!r}"
+                raise ValueError(msg)
+            if word == "hundred":
+                current *= 100
+            else:
+                total += current * NUMBER_MULTIPLIERS[word]
+                current = 0
+        else:
+            msg = f"Unknown number word {word!r} in {value!r}"
+            raise ValueError(msg)
+
+    return total + current
+
+
+def parse_date(date_str: str) -> date | None:
+    """Parse a date string in one of the known DATE_FORMATS, or return None."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str.strip(), date_format).date()  # noqa: DTZ007
+        except ValueError:
+            continue
+    return None
+
+
+def parse_time(time_str: str) -> time | None:
+    """Parse a time string like "8:00 a.m." or "13:45:00" in one of the known TIME_FORMATS, or return None."""
+    time_str = time_str.strip().lower().replace("a.m.", "am").replace("p.m.", "pm")
+    if time_str == "noon":
+        return time(12, 0)
+    if time_str == "midnight":
+        return time(0, 0)
+
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(time_str, time_format).time()  # noqa: DTZ007
+        except ValueError:
+            continue
+    return None
+
+
+def try_parse_datetime(date_str: str, time_str: str | None) -> datetime | None:
+    """Parse the start datetime of an event without the AI model.
+
+    A missing time is assumed to be 00:00:00. Returns None if either value is in a format we don't know.
+    """
+    start_date = parse_date(date_str)
+    if start_date is None:
+        return None
+
+    time_str = check_for_na_value(time_str)
+    if time_str is None:
+        return datetime.combine(start_date, time(0, 0))
+
+    start_time = parse_time(time_str)
+    if start_time is None:
+        return None
+
+    return datetime.combine(start_date, start_time)
+
+
+def try_parse_restored_datetime(date_str: str, restoration_str: str) -> datetime | None:
+    """Parse a restoration time like "6:00 a.m. June 2" without the AI model.
+
+    The year is taken from the start date, or the following year if the restoration date is earlier than the start
+    date. A missing time is assumed to be 23:59:59. Returns None if either value is in a format we don't know, or if
+    the restoration would be MAX_RESTORATION_MONTHS or more after the start.
+    """
+    start_date = parse_date(date_str)
+    if start_date is None:
+        return None
+
+    restored = parse_restoration(start_date, restoration_str.strip())
+    if restored is None or months_between(start_date, restored.date()) >= MAX_RESTORATION_MONTHS:
+        return None
+
+    return restored
+
+
+def parse_restoration(start_date: date, restoration_str: str) -> datetime | None:
+    """Parse a restoration time relative to the start date, or return None."""
+    # Some files already have a full datetime, or just a date
+    try:
+        return datetime.combine(date.fromisoformat(restoration_str), time(23, 59, 59))
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(restoration_str)
+    except ValueError:
+        pass
+
+    match = RESTORATION_TIME_RE.fullmatch(restoration_str)
+    month = MONTHS.get(match.group(2).lower()) if match else None
+    if match is None or month is None:
+        return None
+
+    restored_time = time(23, 59, 59) if match.group(1) is None else parse_time(match.group(1))
+    if restored_time is None:
+        return None
+
+    # The date may not exist, e.g. Feb 29 outside a leap year, either in the start date's year or the following one
+    try:
+        restored_date = date(start_date.year, month, int(match.group(3)))
+        if restored_date < start_date:
+            restored_date = restored_date.replace(year=start_date.year + 1)
+    except ValueError:
+        return None
+
+    return datetime.combine(restored_date, restored_time)
+
+
+def months_between(start: date, end: date) -> int:
+    """Count the whole calendar months from start to end."""
+    months = (end.year - start.year) * 12 + end.month - start.month
+    if end.day < start.day:
+        months -= 1
+    return months
@@ -0,0 +1,116 @@
+"""Tests for reading the multi-row and Batch API responses."""
+
+import asyncio
+import json
+from collections.abc import Iterator
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+import httpx
+import pytest
+from openai import BadRequestError, ContentFilterFinishReasonError, RateLimitError
+
+from poweroutageanalysis.ai import DateBatchResponse, DateItem, DateResponse, PowerOutageAI
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+# The rows of a multi-row datetime request
+ROWS = [{"id": row_id, "date": "1/30/02", "time": "8:00 a.m."} for row_id in range(3)]
+
+
+@pytest.fixture()
+def ai(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[PowerOutageAI]:
+    """Create a PowerOutageAI with its response cache in a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+
+    ai = PowerOutageAI()
+    yield ai
+    ai.cache.close()
+
+
+def output_line(
+    custom_id: str,
+    content: str | None = '{"datetime": "2002-01-30T08:00:00"}',
+    status_code: int = 200,
+    finish_reason: str = "stop",
+) -> str:
+    """Build one line of a Batch API output file."""
+    return json.dumps(
+        {
+            "custom_id": custom_id,
+            "error": None,
+            "response": {
+                "status_code": status_code,
+                "body": {"choices": [{"finish_reason": finish_reason, "message": {"content": content}}]},
+            },
+        },
+    )
+
+
+def test_parse_batch_output(ai: PowerOutageAI) -> None:
+    """Each successful line is parsed into a DateResponse keyed by its custom_id, skipping blank lines."""
+    text = "\n".join([output_line("0"), "", output_line("1", '{"datetime": "2002-02-07T23:59:59"}')])
+
+    assert ai.parse_batch_output(text) == {
+        "0": DateResponse(datetime="2002-01-30T08:00:00"),
+        "1": DateResponse(datetime="2002-02-07T23:59:59"),
+    }
+
+
+@pytest.mark.parametrize(
+    "failed_line",
+    [
+        output_line("1", status_code=500),
+        json.dumps({"custom_id": "1", "error": {"code": "server_error"}, "response": None}),
+        output_line("1", '{"datetime": "2002-', finish_reason="length"),
+        output_line("1", None),
+        output_line("1", '{"datetime": "2002-'),
+        output_line("1", '{"date": "2002-01-30"}'),
+    ],
+    ids=["failed status", "error", "cut off", "no content", "invalid json", "wrong schema"],
+)
+def test_parse_batch_output_skips_failed_lines(ai: PowerOutageAI, failed_line: str) -> None:
+    """A failed line is skipped without losing the rest of the batch."""
+    text = "\n".join([output_line("0"), failed_line, output_line("2")])
+
+    assert set(ai.parse_batch_output(text)) == {"0", "2"}
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ContentFilterFinishReasonError(),
+        BadRequestError("Too many tokens", response=httpx.Response(400, request=REQUEST), body=None),
+    ],
+    ids=["content filter", "bad request"],
+)
+def test_parse_datetimes_batch_falls_back(
+    ai: PowerOutageAI,
+    monkeypatch: pytest.MonkeyPatch,
+    error: Exception,
+) -> None:
+    """A multi-row request that can't be completed leaves every row to the per-event fallback."""
+    monkeypatch.setattr(ai, "parse_completion", AsyncMock(side_effect=error))
+
+    assert asyncio.run(ai.parse_datetimes_batch("system prompt", ROWS)) == {}
+
+
+def test_parse_datetimes_batch_raises_rate_limit(ai: PowerOutageAI, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Rate limit errors have already been retried, so they aren't multiplied into per-event requests."""
+    error = RateLimitError("Rate limit reached", response=httpx.Response(429, request=REQUEST), body=None)
+    monkeypatch.setattr(ai, "parse_completion", AsyncMock(side_effect=error))
+
+    with pytest.raises(RateLimitError):
+        asyncio.run(ai.parse_datetimes_batch("system prompt", ROWS))
+
+
+def test_parse_datetimes_batch_drops_unknown_ids(ai: PowerOutageAI, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Only ids that were sent, and answered once, are used."""
+    items = [DateItem(id=row_id, datetime=f"2002-01-0{row_id + 1}T00:00:00") for row_id in (0, 1, 1, 2, 5, -1)]
+    monkeypatch.setattr(ai, "parse_completion", AsyncMock(return_value=DateBatchResponse(items=items)))
+
+    assert asyncio.run(ai.parse_datetimes_batch("system prompt", ROWS)) == {
+        0: "2002-01-01T00:00:00",
+        2: "2002-01-03T00:00:00",
+    }
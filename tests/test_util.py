@@ -0,0 +1,139 @@
+"""Tests for the parsers that clean the data without the AI model."""
+
+from datetime import date, datetime, time
+
+import pandas as pd
+import pytest
+
+from poweroutageanalysis.util import (
+    clean_num_series,
+    months_between,
+    parse_number_words,
+    parse_time,
+    split_region_series,
+    try_parse_datetime,
+    try_parse_restored_datetime,
+    words_to_number,
+)
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("36,073", 36073),
+        ("Approx. 2 million", 2_000_000),
+        ("25k", 25_000),
+        ("1.5 thousand", 1_500),
+        ("two thousand", 2_000),
+        ("36073 (residential)", 36073),
+    ],
+)
+def test_parse_number_words(value: str, expected: int) -> None:
+    """Numbers with commas, multipliers, words and trailing notes are parsed."""
+    assert parse_number_words(value) == expected
+
+
+@pytest.mark.parametrize("value", ["300 m", "unknown", ""])
+def test_parse_number_words_invalid(value: str) -> None:
+    """A bare "m" is not a million (it's megawatts), and anything else unknown is left to the AI model."""
+    with pytest.raises(ValueError, match="number word"):
+        parse_number_words(value)
+
+
+@pytest.mark.parametrize("value", ["K", "thousand", "Million", "hundred", "hundred thousand", "two million thousand"])
+def test_parse_number_words_bare_multiplier(value: str) -> None:
+    """A multiplier without a number before it doesn't say how many, so it is left to the AI model."""
+    with pytest.raises(ValueError, match="No number before"):
+        parse_number_words(value)
+
+
+def test_words_to_number() -> None:
+    """Compound English numbers are added up."""
+    assert words_to_number("two hundred fifty thousand") == 250_000
+    assert words_to_number("one hundred and twenty-five") == 125
+    assert words_to_number("one million two hundred thousand") == 1_200_000
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("8:00 a.m.", time(8, 0)),
+        ("6:30 p.m.", time(18, 30)),
+        ("13:45:00", time(13, 45)),
+        ("Noon", time(12, 0)),
+        ("Evening", None),
+    ],
+)
+def test_parse_time(value: str, expected: time | None) -> None:
+    """Times are parsed in the known formats, or None."""
+    assert parse_time(value) == expected
+
+
+def test_try_parse_datetime() -> None:
+    """The start datetime combines the date and time, with a missing time at midnight."""
+    assert try_parse_datetime("8/9/00", "6:30 p.m.") == datetime(2000, 8, 9, 18, 30)
+    assert try_parse_datetime("2002-01-30", "N/A") == datetime(2002, 1, 30)
+    assert try_parse_datetime("2002-01-30", "Evening") is None
+
+
+@pytest.mark.parametrize(
+    ("restoration", "expected"),
+    [
+        ("6:00 a.m. June 2", datetime(2000, 6, 2, 6, 0)),
+        ("Noon Sept. 10", datetime(2000, 9, 10, 12, 0)),
+        ("June 2", datetime(2000, 6, 2, 23, 59, 59)),
+        ("2000-06-02 14:00:00", datetime(2000, 6, 2, 14, 0)),
+        ("2000-06-02", datetime(2000, 6, 2, 23, 59, 59)),
+    ],
+)
+def test_try_parse_restored_datetime(restoration: str, expected: datetime) -> None:
+    """Restoration times take the start date's year, and a missing time is 23:59:59."""
+    assert try_parse_restored_datetime("5/31/00", restoration) == expected
+
+
+def test_try_parse_restored_datetime_year_rollover() -> None:
+    """A restoration date before the start date is in the following year."""
+    assert try_parse_restored_datetime("12/30/00", "3:00 p.m. January 2") == datetime(2001, 1, 2, 15, 0)
+
+
+@pytest.mark.parametrize(
+    "restoration",
+    [
+        # Rolling over to the next year would make this a year long outage
+        "11:59 p.m. August 7",
+        "2001-02-09 00:00:00",
+        # Feb 29 is before the start in a leap year, and would roll over to a year without it
+        "Feb 29",
+        "6:00 a.m. February 29",
+        # Not month names
+        "Mayor 5",
+        "Junk 3",
+        "Unknown",
+    ],
+)
+def test_try_parse_restored_datetime_left_to_ai(restoration: str) -> None:
+    """Restorations 6 months or more after the start, or in an unknown format, are left to the AI model."""
+    assert try_parse_restored_datetime("8/9/00", restoration) is None
+
+
+def test_months_between() -> None:
+    """Only whole calendar months are counted."""
+    assert months_between(date(2000, 8, 9), date(2001, 2, 8)) == 5
+    assert months_between(date(2000, 8, 9), date(2001, 2, 9)) == 6
+
+
+def test_clean_num_series() -> None:
+    """Clean numbers are converted, missing values are NA, and the rest are flagged as failed."""
+    numbers, failed = clean_num_series(pd.Series(["1,200", "Approx. 500", "100-300", "N/A", None, "a few", "2.5"]))
+
+    assert numbers.tolist() == [1200, 500, 300, pd.NA, pd.NA, pd.NA, pd.NA]
+    assert failed.tolist() == [False, False, False, False, False, True, True]
+
+
+def test_split_region_series() -> None:
+    """The NERC region is split off the end of the utility names, when there is one."""
+    region, utility_name = split_region_series(pd.Series([" Duke Power Co. (SERC) ", "PG&E", "City (of Austin)"]))
+
+    assert region.tolist()[0] == "SERC"
+    assert region.isna().tolist() == [False, True, True]
+    assert utility_name.tolist() == ["Duke Power Co.", "PG&E", "City (of Austin)"]